@@ -1,13 +1,229 @@
 #!/usr/bin/env python3
 
+import math
+import os
 import numpy as np
+import scipy.fft
+import scipy.linalg
+from numba import njit, prange
 import aotools
 from pydantic import BaseModel, ConfigDict
 from tqdm import tqdm
 import time
 from typing import Union
 from pyMilk.interfacing.isio_shmlib import SHM
-import aocov
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+
+@njit(fastmath=True, cache=True)
+def _bessel_kv(nu, x, gampl, gammi):
+    """Modified Bessel function of the second kind, K_nu(x), for x > 0, using
+    Temme's series (x < 2) or Steed's continued fraction (x >= 2), followed by
+    upward recurrence in the order (see Numerical Recipes, `bessik`).
+
+    `gampl` and `gammi` are 1/gamma(1+mu) and 1/gamma(1-mu), with
+    mu = nu - int(nu+0.5), precomputed since they only depend on `nu`.
+    """
+    nl = int(nu + 0.5)
+    xmu = nu - nl
+    xmu2 = xmu*xmu
+    xi = 1.0/x
+    xi2 = 2.0*xi
+    if x < 2.0:
+        x2 = 0.5*x
+        pimu = math.pi*xmu
+        fact = 1.0 if abs(pimu) < 1e-16 else pimu/math.sin(pimu)
+        d = -math.log(x2)
+        e = xmu*d
+        fact2 = 1.0 if abs(e) < 1e-16 else math.sinh(e)/e
+        if abs(xmu) < 1e-16:
+            gam1 = -0.5772156649015329
+        else:
+            gam1 = (gammi-gampl)/(2.0*xmu)
+        gam2 = (gammi+gampl)/2.0
+        ff = fact*(gam1*math.cosh(e) + gam2*fact2*d)
+        s = ff
+        e = math.exp(e)
+        p = 0.5*e/gampl
+        q = 0.5/(e*gammi)
+        c = 1.0
+        d = x2*x2
+        s1 = p
+        for i in range(1, 10000):
+            ff = (i*ff + p + q)/(i*i - xmu2)
+            c *= d/i
+            p /= i - xmu
+            q /= i + xmu
+            delta = c*ff
+            s += delta
+            s1 += c*(p - i*ff)
+            if abs(delta) < abs(s)*1e-16:
+                break
+        rkmu = s
+        rk1 = s1*xi2
+    else:
+        b = 2.0*(1.0 + x)
+        d = 1.0/b
+        h = d
+        delh = d
+        q1 = 0.0
+        q2 = 1.0
+        a1 = 0.25 - xmu2
+        q = a1
+        c = a1
+        a = -a1
+        s = 1.0 + q*delh
+        for i in range(2, 10000):
+            a -= 2*(i - 1)
+            c = -a*c/i
+            qnew = (q1 - b*q2)/a
+            q1 = q2
+            q2 = qnew
+            q += c*qnew
+            b += 2.0
+            d = 1.0/(b + a*d)
+            delh = (b*d - 1.0)*delh
+            h += delh
+            dels = q*delh
+            s += dels
+            if abs(dels/s) < 1e-16:
+                break
+        h = a1*h
+        rkmu = math.sqrt(math.pi/(2.0*x))*math.exp(-x)/s
+        rk1 = rkmu*(xmu + x + 0.5 - h)*xi
+    for i in range(1, nl+1):
+        rktemp = (xmu + i)*xi2*rk1 + rkmu
+        rkmu = rk1
+        rk1 = rktemp
+    return rkmu
+
+
+_COV_TILE = 256  # (256, 256) float64 output tile fits in L2
+_NOISE_POOL_BYTES = 64*1024  # driving noise drawn at once, small to keep refills short
+_L2_BYTES = 1024*1024  # assumed (per core) L2 cache size
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def phase_cov_vk(x_out, y_out, x_in, y_in, r0, L0):
+    """von Karman phase covariance (in rad^2 at 0.5 micron) between the
+    points (x_out, y_out) and (x_in, y_in), in metres.
+
+    Same closed form as `aocov.phase_covariance_xyxy`, evaluated in parallel
+    over (_COV_TILE, _COV_TILE) blocks of the output. If both sets of points
+    are the same, only the upper triangle of blocks is evaluated.
+    """
+    n_out = x_out.shape[0]
+    n_in = x_in.shape[0]
+    cov = np.empty((n_out, n_in))
+    symmetric = n_out == n_in
+    if symmetric:
+        for i in range(n_out):
+            if x_out[i] != x_in[i] or y_out[i] != y_in[i]:
+                symmetric = False
+                break
+    nu = 5/6
+    xmu = nu - int(nu+0.5)
+    gampl = 1.0/math.gamma(1.0+xmu)
+    gammi = 1.0/math.gamma(1.0-xmu)
+    coeff = (L0/r0)**(5/3) * (2**(-5/6)) * math.gamma(11/6) / \
+        (math.pi**(8/3)) * ((24/5)*math.gamma(6/5))**(5/6)
+    # limit of x**nu * K_nu(x) as x -> 0
+    cov_zero = coeff * math.gamma(nu) * 2**(nu-1)
+    nb_out = (n_out + _COV_TILE - 1)//_COV_TILE
+    nb_in = (n_in + _COV_TILE - 1)//_COV_TILE
+    for blk in prange(nb_out*nb_in):
+        bi = blk // nb_in
+        bj = blk % nb_in
+        if symmetric and bi > bj:
+            continue
+        for i in range(bi*_COV_TILE, min((bi+1)*_COV_TILE, n_out)):
+            for j in range(bj*_COV_TILE, min((bj+1)*_COV_TILE, n_in)):
+                r = math.sqrt((x_out[i]-x_in[j])**2 + (y_out[i]-y_in[j])**2)
+                xn = 2*math.pi*r/L0
+                if xn == 0.0:
+                    c = cov_zero
+                else:
+                    c = coeff * xn**nu * _bessel_kv(nu, xn, gampl, gammi)
+                cov[i, j] = c
+                if symmetric:
+                    cov[j, i] = c
+    return cov
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def build_camp(phi, pupil, ramp, subap_idx, nsubx, subwidth, k, out):
+    """Compute the complex amplitude `pupil * exp(1j*(k*phi + ramp))` of the
+    subapertures `subap_idx` (flat indices in the (nsub, nsub) grid), writing
+    it directly into `out` batched by subaperture, i.e., with shape:
+        (len(subap_idx), subwidth*subwidth)
+    where `ramp` (subwidth*subwidth) is a phase applied to every subaperture.
+    """
+    for n in prange(subap_idx.shape[0]):
+        i = subap_idx[n] // nsubx
+        j = subap_idx[n] % nsubx
+        for u in range(subwidth):
+            py = i*subwidth + u
+            for v in range(subwidth):
+                px = j*subwidth + v
+                q = u*subwidth + v
+                if pupil[py, px]:
+                    # the branch only skips the trig outside the pupil
+                    arg = k*phi[py, px] + ramp[q]
+                    out[n, q] = pupil[py, px]*(np.cos(arg) + 1j*np.sin(arg))
+                else:
+                    out[n, q] = 0.0
+
+
+@njit(fastmath=True, cache=True, error_model="numpy")
+def _cog_subap(im, thresh, clip):
+    """Thresholded centre of gravity of a single [npix,npix] image, computed
+    in a single pass.
+    """
+    npix = im.shape[0]
+    s = 0.0
+    sx = 0.0
+    sy = 0.0
+    for py in range(npix):
+        y = py - npix/2 + 0.5
+        for px in range(npix):
+            x = px - npix/2 + 0.5
+            val = im[py, px] - thresh
+            if clip and val < 0:
+                val = 0.0
+            s += val
+            sx += val*x
+            sy += val*y
+    return sx/s, sy/s
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _cog_kernel(intensity, thresh, clip, out):
+    """Thresholded centre of gravity of each image in the [N,npix,npix] batch
+    `intensity`, written to `out` ([N,2]).
+    """
+    for b in prange(intensity.shape[0]):
+        out[b, 0], out[b, 1] = _cog_subap(intensity[b], thresh, clip)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _cog_kernel_valid(intensity, idx, thresh, clip, scale, out):
+    """Thresholded centre of gravity of the images `idx` in the [N,npix,npix]
+    batch `intensity`, scaled by `scale` and written to `out` ([2*M]) in yao
+    slope format, i.e., all x slopes followed by all y slopes.
+    """
+    m = idx.shape[0]
+    for k in prange(m):
+        x, y = _cog_subap(intensity[idx[k]], thresh, clip)
+        out[k] = x*scale
+        out[m+k] = y*scale
+
 
 class PhaseScreen(BaseModel):
     model_config = ConfigDict(arbitrary_types_allowed=True)
@@ -27,6 +243,14 @@ class PhaseScreen(BaseModel):
     x: np.ndarray = None
     seed: int = 1234
     rng: np.random.Generator = None
+    # per-frame buffers are plain fields rather than private attributes,
+    # since pydantic is ~50x slower to read the latter
+    phase_buf: np.ndarray = None
+    pupil_mask: np.ndarray = None
+    noise_pool: np.ndarray = None
+    noise_i: int = 0
+    x_next: np.ndarray = None
+    gemv: object = None
 
     class StateMatrix:
         """Special class for the state matrix, since I realised it has some
@@ -34,53 +258,54 @@ class PhaseScreen(BaseModel):
         faster.
         """
         def __init__(self, cov_yx, inv_factor_xx):
-            self.ML = np.einsum("ij,jk->ik", cov_yx, inv_factor_xx)
-            self.LT = inv_factor_xx.T.copy()
-            self.A = np.einsum("ij,jk->ik", self.ML, self.LT)
-            x = np.ones(self.A.shape[1])
-            self.es_path_factored = np.einsum_path(
-                "ij,jk,k...->i...",
-                self.ML,
-                self.LT,
-                x,
-                optimize="optimal"
-            )
-            self.es_path_classic = np.einsum_path(
-                "ij,j...->i...", 
-                self.A, x, optimize="optimal"
+            # store each matrix in the layout that BLAS gemv reads with unit
+            # stride: Fortran order for the tall ML and square A, while the
+            # wide LT is already best read row by row (C order).
+            self.ML = np.asfortranarray(
+                (cov_yx @ inv_factor_xx).astype(np.float32)
             )
+            self.LT = np.ascontiguousarray(inv_factor_xx.T, dtype=np.float32)
+            self.A = np.asfortranarray(self.ML @ self.LT)
+            self._gemv = scipy.linalg.blas.get_blas_funcs("gemv", (self.A,))
+            # scratch for LT @ x in the factored `dot_into`
+            self._lt_buf = np.zeros(self.LT.shape[0], dtype=self.LT.dtype)
             res = self.test_speed(10)
             if res["classic"] > res["factored"]:
                 # classic was slower, use factored
-                self.dot = self.dot_factored
+                self.dot = lambda x: self._mv(self.ML, self._mv(self.LT, x))
+                self.dot_into = lambda x, y: self._mv(
+                    self.ML, self._mv(self.LT, x, self._lt_buf), y
+                )
             else:
                 # factored was slower, use classic
-                self.dot = self.dot_classic
+                self.dot = lambda x: self._mv(self.A, x)
+                self.dot_into = lambda x, y: self._mv(self.A, x, y)
+
+        def _mv(self, mat, x, y=None):
+            """`mat @ x`, calling BLAS gemv directly when `x` is a vector to
+            skip numpy's dispatch overhead, writing into `y` if given.
+            """
+            if x.ndim != 1:
+                return mat @ x
+            if mat.flags.f_contiguous:
+                return self._gemv(1.0, mat, x, y=y, overwrite_y=True)
+            # the transpose of a C-ordered `mat` is Fortran-ordered, so BLAS
+            # can use it without a copy
+            return self._gemv(1.0, mat.T, x, y=y, overwrite_y=True, trans=1)
 
-        def dot_classic(self, x):
-            return np.einsum(
-                "ij,j...->i...",
-                self.A, x, optimize=self.es_path_classic[0])
-        
-        def dot_factored(self, x):
-            return np.einsum(
-                "ij,jk,k...->i...",
-                self.ML,
-                self.LT,
-                x,
-                optimize=self.es_path_factored[0])
-        
         @property
         def shape(self):
             return self.A.shape
 
         def test_speed(self, ntests=100, seed=1):
             rng = np.random.default_rng(seed)
-            x = rng.normal(size=[self.shape[1],ntests])
+            x = rng.normal(size=[ntests,self.shape[1]]).astype(self.A.dtype)
             t1 = time.time()
-            self.dot_factored(x)
+            for xi in x:
+                self._mv(self.ML, self._mv(self.LT, xi))
             t2 = time.time()
-            self.dot_classic(x)
+            for xi in x:
+                self._mv(self.A, xi)
             t3 = time.time()
             print(f"classic:  {(t3-t2)/ntests:0.3e}")
             print(f"factored: {(t2-t1)/ntests:0.3e}")
@@ -95,11 +320,14 @@ class PhaseScreen(BaseModel):
         super().__init__(*args, **kwargs)
 
         self.rng = np.random.default_rng(self.seed)
+        self.phase_buf = np.zeros(self.pupil.shape, dtype=np.float32)
+        self.pupil_mask = self.pupil.astype(bool)
 
         self.pixsize = self.diam / self.pupil.shape[0]
-        yy, xx = np.mgrid[:pup_width, :pup_width]*self.pixsize
-        yy = yy[self.pupil == 1]
-        xx = xx[self.pupil == 1]
+        # coordinates of the valid pixels, in the same order as the state
+        yy, xx = np.nonzero(self.pupil_mask)
+        yy = yy*self.pixsize
+        xx = xx*self.pixsize
 
         # let sigma_xx -> covariance of phase with self
         # let sigma_yx -> covariance between phase and next phase
@@ -116,36 +344,78 @@ class PhaseScreen(BaseModel):
         sigma_vv = sigma_xx - state_matrix.dot(state_matrix.dot(sigma_xx).T).T
         self.state_matrix = state_matrix
         self.factor_vv, _ = self._factorh(sigma_vv, self.vv_max)
-        self.x = self.factor_xx @ self.rng.normal(size=self.factor_xx.shape[1])
+        # Fortran order, so that gemv can accumulate with it without a copy
+        self.factor_vv = np.asfortranarray(self.factor_vv)
+        self.gemv = scipy.linalg.blas.get_blas_funcs("gemv", (self.factor_vv,))
+        self.x = self.factor_xx @ self.rng.standard_normal(
+            size=self.factor_xx.shape[1], dtype=np.float32
+        )
+        self.x_next = np.empty_like(self.x)
+        self._refill_noise()
 
     def _covariance(self, x_in, y_in, x_out, y_out):
-        cov = aocov.phase_covariance_xyxy(
+        cov = phase_cov_vk(
             x_out, y_out, x_in, y_in,
             self.r0, self.L0
             )*(0.5/(np.pi*2))**2
         return cov
 
     def _factorh(self, symmetric_matrix, n_modes=None):
-        vals, vecs = np.linalg.eigh(symmetric_matrix)
-        if n_modes is None:
-            valid = vals > self.thresh
+        n = symmetric_matrix.shape[0]
+        if n_modes is not None and n_modes < n/2:
+            # only compute the eigenpairs that are kept
+            vals, vecs = scipy.linalg.eigh(
+                symmetric_matrix, subset_by_index=[n-n_modes, n-1]
+            )
+            valid = vals > 0
         else:
-            valid = vals >= vals[vals.argsort()[-n_modes]]
+            vals, vecs = np.linalg.eigh(symmetric_matrix)
+            if n_modes is None:
+                valid = vals > self.thresh
+            else:
+                valid = vals >= vals[vals.argsort()[-n_modes]]
         vecs = vecs[:, valid]
         vals = vals[valid]
         factor = vecs * (vals**0.5)[None,:]
         inv_factor = vecs * ((1/vals)**0.5)[None,:]
-        return factor, inv_factor
+        # the decomposition needs double precision, but propagating the state
+        # doesn't, so keep the factors in single precision from here on.
+        return factor.astype(np.float32), inv_factor.astype(np.float32)
+
+    def _refill_noise(self):
+        """Draw the driving noise for the next few steps at once, since
+        drawing a small vector per step is dominated by overhead. The pool is
+        kept to _NOISE_POOL_BYTES, so that a refill doesn't stall the step
+        it happens in.
+        """
+        if self.noise_pool is None:
+            nmodes = self.factor_vv.shape[1]
+            nsteps = max(1, _NOISE_POOL_BYTES//(4*nmodes))
+            self.noise_pool = np.empty((nsteps, nmodes), dtype=np.float32)
+        self.rng.standard_normal(dtype=np.float32, out=self.noise_pool)
+        self.noise_i = 0
 
     def step(self):
-        v = self.rng.normal(size=self.factor_vv.shape[1])
-        self.x = self.state_matrix.dot(self.x) + self.factor_vv @ v
+        if self.noise_i == len(self.noise_pool):
+            self._refill_noise()
+        v = self.noise_pool[self.noise_i]
+        self.noise_i += 1
+        # x_next = A @ x + factor_vv @ v, without any temporaries
+        self.state_matrix.dot_into(self.x, self.x_next)
+        self.gemv(
+            1.0, self.factor_vv, v, beta=1.0, y=self.x_next, overwrite_y=True
+        )
+        self.x, self.x_next = self.x_next, self.x
 
     @property
     def phase(self):
-        phi = np.zeros(self.pupil.shape)
-        phi[self.pupil] = self.x.copy()
-        return phi.astype(np.float32)
+        """Current phase over the pupil (zero outside), in microns.
+
+        This is a view of a buffer that is overwritten on the next access, so
+        callers that modify it or need it to persist should take a copy.
+        """
+        self.phase_buf[self.pupil_mask] = self.x
+        return self.phase_buf
 
 
 class SHWFS(BaseModel):
@@ -154,13 +424,24 @@ class SHWFS(BaseModel):
     nsubx: int = 32  # number of subapertures across diameter
     fovx: int = 8  # pixels per fov width
     wavelength: float = 0.589  # sensing wavelength in microns
-    dft2: np.ndarray = None
+    dft: np.ndarray = None
     slices: list = None
-    es_path: tuple = None
-    _im_subaps: np.ndarray = None
-    _im_full: np.ndarray = None
     diam: float = 8.0 # metre telescope
     padded_width: float = None
+    use_fft: bool = True  # batched FFT, otherwise the separable DFT method
+    dft_tile: int = None  # subapertures per batch in the DFT method
+    # per-frame buffers, plain fields since reading private attributes is slow
+    camp: np.ndarray = None
+    camp_pad: np.ndarray = None
+    ramp: np.ndarray = None
+    fft_out: np.ndarray = None
+    dft_tmp: np.ndarray = None
+    dft_tmp_t: np.ndarray = None
+    fftw: object = None
+    subap_idx: np.ndarray = None
+    intensity_subset: np.ndarray = None
+    intensity: np.ndarray = None
+    image_buf: np.ndarray = None
 
     @property
     def pixel_scale(self):
@@ -171,25 +452,78 @@ class SHWFS(BaseModel):
 
         padded_width = np.max([self.subwidth*2, self.fovx])
         self.padded_width = padded_width
+        # subapertures with no pupil in them are always dark, so only the
+        # subapertures with some pupil are measured.
+        sw = self.subwidth
+        self.subap_idx = np.flatnonzero(
+            self.pupil.reshape(self.nsubx, sw, self.nsubx, sw).any(axis=(1, 3))
+        )
+        nsub = len(self.subap_idx)
+        # complex amplitude batched by subaperture, filled by `build_camp`
+        self.camp = np.zeros((nsub, sw*sw), dtype=np.complex64)
+        # intensity of the measured subapertures
+        self.intensity_subset = np.zeros(
+            (nsub, self.fovx, self.fovx), dtype=np.float32
+        )
+        # intensity of all subapertures, the output of `measure`
+        self.intensity = np.zeros(
+            (self.nsubx*self.nsubx, self.fovx, self.fovx),
+            dtype=np.float32
+        )
+        # scratch for the full image in `image_uint8`, in the order of its
+        # [nsubx,fovx,nsubx,fovx] tiles
+        self.image_buf = np.zeros(
+            (self.nsubx, self.fovx, self.nsubx, self.fovx), dtype=np.float32
+        )
+        # half-pixel phase ramp across each subaperture, so that a flat
+        # wavefront lands between the 4 central pixels. It is applied to the
+        # complex amplitude in `build_camp`, rather than baked into the DFT.
+        u = np.arange(sw)
+        uu = (u[:,None]+u[None,:]).ravel()
+        ramp = -np.pi*uu/padded_width
+        if self.use_fft:
+            # combined with the shift theorem equivalent of an fftshift, so
+            # that the output of the fft only needs to be cropped (a view, no
+            # copy).
+            ramp += 2*np.pi*(padded_width//2)*uu/padded_width
+        self.ramp = ramp.astype(np.float32)
+        if self.use_fft:
+            shape = (nsub, padded_width, padded_width)
+            if pyfftw is None:
+                self.camp_pad = np.zeros(shape, dtype=np.complex64)
+                return
+            # preplanned FFTW transform batched over the subapertures
+            self.camp_pad = pyfftw.zeros_aligned(shape, dtype=np.complex64)
+            self.fft_out = pyfftw.zeros_aligned(shape, dtype=np.complex64)
+            self.fftw = pyfftw.FFTW(
+                self.camp_pad, self.fft_out, axes=(-2, -1),
+                flags=("FFTW_MEASURE",), threads=os.cpu_count(),
+                ortho=True, normalise_idft=False
+            )
+            # planning with FFTW_MEASURE overwrites the input
+            self.camp_pad[:] = 0.0
+            return
+
         dft = np.fft.fft(np.eye(padded_width), norm="ortho")
         dft = np.fft.fftshift(dft, axes=[0])
-        dft = dft[:, :self.subwidth]*np.exp(-1j*np.pi*2*np.arange(self.subwidth)/self.padded_width/2)[None,:]
+        dft = dft[:, :self.subwidth]
         if self.fovx < padded_width:
             dft = dft[
                 padded_width//2-self.fovx//2:padded_width//2+self.fovx//2
             ]
-        dft2 = np.kron(dft, dft)
-        self.dft2 = dft2
-        
-        camp = pupil.astype(np.complex128)
-        # reshape camp so that it's batched into a 4d array with shape:
-        #   (nsub, nsub, subwidth, subwidth)
-        camp = camp.reshape(self.nsubx, self.subwidth, self.nsubx, self.subwidth).swapaxes(1, 2)
-        # flatten the `subwidth` dimensions:
-        camp = camp.reshape(self.nsubx, self.nsubx, self.subwidth*self.subwidth)
-        # get the optimal einsum path to use online
-        self.es_path = tuple(
-            np.einsum_path("ijq,pq->ijp",camp,self.dft2,optimize="optimal")
+        # the 2d DFT is separable, so it is applied as a 1d DFT along
+        # each axis of the subapertures
+        self.dft = dft.astype(np.complex64)
+        if self.dft_tile is None:
+            # process the subapertures in batches whose working set (input,
+            # intermediates and output, complex64) fills half of the L2
+            per_subap = 8*(sw*sw + 2*sw*self.fovx + self.fovx*self.fovx)
+            self.dft_tile = max(1, min(nsub, _L2_BYTES//2//per_subap))
+        tile = self.dft_tile
+        self.dft_tmp = np.zeros((tile, sw, self.fovx), dtype=np.complex64)
+        self.dft_tmp_t = np.zeros((tile, self.fovx, sw), dtype=np.complex64)
+        self.fft_out = np.zeros(
+            (nsub, self.fovx, self.fovx), dtype=np.complex64
         )
     
     def measure(self, phi):
@@ -199,69 +533,190 @@ class SHWFS(BaseModel):
         """
         # I'm aware that this is basically unreadable, but it's hella fast.
         
-        # compute complex amplitude from phase and pupil
-        camp = pupil.astype(np.complex128) * \
-            np.exp(1j*phi*2*np.pi/self.wavelength)
-        
-        # reshape camp so that it's batched into a 4d array with shape:
-        #   (nsub, nsub, subwidth, subwidth)
-        camp = camp.reshape(self.nsubx, self.subwidth, self.nsubx, self.subwidth).swapaxes(1, 2)
-        # flatten the phase dimension:
-        camp = camp.reshape(self.nsubx, self.nsubx, self.subwidth*self.subwidth)
-        # do the fft2's batched using the MVM (DFT2) method
-        im = np.einsum("ijq,pq->ijp",camp,self.dft2,optimize=self.es_path[0])
+        # compute complex amplitude from phase and pupil, batched into a 2d
+        # array with shape:
+        #   (nsub, subwidth*subwidth)
+        build_camp(
+            phi, self.pupil, self.ramp, self.subap_idx, self.nsubx,
+            self.subwidth, 2*np.pi/self.wavelength, self.camp
+        )
+        camp = self.camp
+        if self.use_fft:
+            # copy into the padded buffer
+            sw = self.subwidth
+            self.camp_pad[:, :sw, :sw] = camp.reshape(-1, sw, sw)
+            # batched (over the measured subapertures) fft2 of the padded subapertures
+            if self.fftw is not None:
+                im = self.fftw()
+            else:
+                im = scipy.fft.fft2(self.camp_pad, norm="ortho", workers=-1)
+            s = self.padded_width//2 - self.fovx//2
+            im = im[:, s:s+self.fovx, s:s+self.fovx]
+        else:
+            # do the fft2's batched as two matrix products with the (cropped)
+            # 1d DFT matrix, one along each axis. Each is a single GEMM over
+            # a tile of subapertures, the second one leaves the axes swapped.
+            sw = self.subwidth
+            for i0 in range(0, camp.shape[0], self.dft_tile):
+                i1 = min(i0+self.dft_tile, camp.shape[0])
+                tmp = self.dft_tmp[:i1-i0]
+                tmp_t = self.dft_tmp_t[:i1-i0]
+                np.matmul(
+                    camp[i0:i1].reshape(-1, sw), self.dft.T,
+                    out=tmp.reshape(-1, self.fovx)
+                )
+                tmp_t[:] = tmp.swapaxes(1, 2)
+                np.matmul(
+                    tmp_t.reshape(-1, sw), self.dft.T,
+                    out=self.fft_out[i0:i1].reshape(-1, self.fovx)
+                )
+            im = self.fft_out.swapaxes(1, 2)
         # convert camplitude to intensity
-        im = np.abs(im)**2
-        # save a view of the image batched into subapertures (for the centroider)
-        self._im_subaps = im.reshape(self.nsubx*self.nsubx, self.fovx, self.fovx)
-        # reshape into something that looks like a wfs image
-        im = im.reshape(self.nsubx, self.nsubx, self.fovx, self.fovx).swapaxes(1, 2)
-        im = im.reshape(self.nsubx * self.fovx, self.nsubx * self.fovx)
-        # save a view of the image as a full WFS readout
-        self._im_full = im
+        intensity = self.intensity_subset.reshape(im.shape)
+        np.abs(im, out=intensity)
+        np.square(intensity, out=intensity)
+        # scatter into the full batch (unmeasured subapertures stay dark)
+        self.intensity[self.subap_idx] = self.intensity_subset
+        # `intensity` is the image batched into subapertures (for the
+        # centroider), the full WFS image is only assembled when asked for.
 
     @property
     def subwidth(self):
         return self.pupil.shape[0] // self.nsubx
     
+    def _image_tiles(self):
+        """View of the batched image as [nsubx,fovx,nsubx,fovx], i.e., in
+        the pixel order of the full WFS image, without a copy.
+        """
+        im = self.intensity.reshape(self.nsubx, self.nsubx, self.fovx, self.fovx)
+        return im.swapaxes(1, 2)
+
+    @property
+    def image(self):
+        # reshaping the non-contiguous tiles makes the copy
+        return self._image_tiles().reshape(
+            self.nsubx * self.fovx, self.nsubx * self.fovx
+        )
+
+    @property
+    def image_batched(self):
+        return self.intensity.copy()
+
+    @property
+    def image_batched_view(self):
+        """The image batched into subapertures, [nsubx*nsubx,fovx,fovx],
+        without a copy (e.g., to pass to a centroider every frame).
+
+        This is the buffer that `measure` writes to, so it is overwritten by
+        the next `measure` and must not be modified.
+        """
+        return self.intensity
+
+    def image_uint8(self, out=None):
+        """WFS image normalised to its peak and quantised to uint8, e.g., for
+        display. Returns the image (written to `out` if given) and the peak
+        intensity, which scales it back to intensity.
+        """
+        peak = self.intensity.max()
+        width = self.nsubx * self.fovx
+        if out is None:
+            out = np.empty((width, width), dtype=np.uint8)
+        # write straight from the tiles, without assembling the full image
+        out_tiles = out.reshape(self.nsubx, self.fovx, self.nsubx, self.fovx)
+        if peak > 0:
+            # round to the nearest level, since the cast truncates
+            np.multiply(self._image_tiles(), 255.0/peak, out=self.image_buf)
+            np.rint(self.image_buf, out=self.image_buf)
+            np.copyto(out_tiles, self.image_buf, casting="unsafe")
+        else:
+            out[:] = 0
+        return out, peak
+
+
+class SHWFS_GPU(SHWFS):
+    """SHWFS with the whole measurement done on a CUDA device with CuPy.
+
+    `measure` accepts `phi` as either a numpy or cupy array. The batched
+    image (`image_batched_view`) stays on the device so that it can be passed
+    straight to `ClassicCogGPU`, while `image` and `image_batched` return numpy
+    arrays.
+    """
+    pupil_gpu: object = None
+    ramp_gpu: object = None
+    camp_pad_gpu: object = None
+
+    def __init__(self, *args, **kwargs):
+        if cp is None:
+            raise ImportError("SHWFS_GPU requires cupy")
+        BaseModel.__init__(self, *args, **kwargs)
+        padded_width = np.max([self.subwidth*2, self.fovx])
+        self.padded_width = padded_width
+        sw = self.subwidth
+        self.pupil_gpu = cp.asarray(self.pupil, dtype=cp.float32)
+        # half-pixel ramp, combined with the shift theorem equivalent of an
+        # fftshift, so that the output needs only be cropped.
+        u = np.arange(sw)
+        uu = u[:,None]+u[None,:]
+        ramp = np.exp(-1j*np.pi*uu/padded_width) * \
+            np.exp(2j*np.pi*(padded_width//2)*uu/padded_width)
+        self.ramp_gpu = cp.asarray(ramp, dtype=cp.complex64)
+        self.camp_pad_gpu = cp.zeros(
+            (self.nsubx*self.nsubx, padded_width, padded_width),
+            dtype=cp.complex64
+        )
+
+    def measure(self, phi):
+        """Measure phase `phi` with shwfs on the GPU.
+
+        Takes `phi` in microns, returns wfs image intensity
+        """
+        sw = self.subwidth
+        phi = cp.asarray(phi, dtype=cp.float32)
+        camp = self.pupil_gpu * cp.exp(
+            (1j*2*np.pi/self.wavelength)*phi
+        ).astype(cp.complex64)
+        camp = camp.reshape(self.nsubx, sw, self.nsubx, sw).swapaxes(1, 2)
+        self.camp_pad_gpu[:, :sw, :sw] = camp.reshape(
+            self.nsubx*self.nsubx, sw, sw
+        ) * self.ramp_gpu
+        # one cuFFT call batched over all subapertures
+        im = cp.fft.fft2(self.camp_pad_gpu, axes=(-2, -1), norm="ortho")
+        s = self.padded_width//2 - self.fovx//2
+        im = im[:, s:s+self.fovx, s:s+self.fovx]
+        im = cp.square(cp.abs(im))
+        self.intensity = im
+
     @property
     def image(self):
-        return self._im_full.copy()
+        return cp.asnumpy(super().image)
 
     @property
     def image_batched(self):
-        return self._im_subaps.copy()
+        return cp.asnumpy(self.intensity)
+
+    def image_uint8(self, out=None):
+        # quantise on the device, so that only the uint8 image is copied back
+        peak = float(self.intensity.max())
+        im = self._image_tiles()
+        if peak > 0:
+            im = cp.rint(im * (255.0/peak))
+        im = im.astype(cp.uint8).reshape(
+            self.nsubx * self.fovx, self.nsubx * self.fovx
+        )
+        return cp.asnumpy(im, out=out), peak
 
 
 class ClassicCog(BaseModel):
     model_config = ConfigDict(arbitrary_types_allowed=True)
     npix : int
-    r_mat : np.ndarray = None
-    xy_mat : np.ndarray = None
     thresh : Union[None, float] = 0.0
-    einsum_num_str : str = "jk,ik,jk->ij"
-    es_path : list = None
 
     def calibrate(self):
-        x_span = np.arange(self.npix)-self.npix/2+0.5
-        xx,yy = np.meshgrid(x_span,x_span,indexing="xy")
-        # xy matrix is [2,Npixels]
-        self.xy_mat = np.concatenate([
-            xx.flatten()[:,None],
-            yy.flatten()[:,None]
-            ],axis=1).T
-        self.r_mat = np.ones(self.xy_mat.shape)
-        self.optimize_einsum()
-
-    def optimize_einsum(self, batch_size=1):
-        intsty = np.zeros([batch_size, self.npix*self.npix])
-        self.es_path = np.einsum_path(
-            self.einsum_num_str,
-            self.r_mat,
-            intsty,
-            self.xy_mat,
-            optimize = self.es_path
-        )
+        """Kept for API compatibility, the pixel coordinates are now computed
+        on the fly in the kernel. This only triggers the JIT compilation so
+        that the first call to `cog` isn't slow.
+        """
+        self.cog(np.zeros([1, self.npix, self.npix], dtype=np.float32))
 
     def cog(self, intensity):
         """compute the centroid of an [npix,npix] image or batch of 
@@ -269,24 +724,243 @@ class ClassicCog(BaseModel):
         """
         if len(intensity.shape)==2:
             intensity = intensity[None,...]
-        if self.thresh is not None:
-            intensity = intensity - self.thresh
-            intensity[intensity < 0] = 0.0
-        num = np.einsum(
-            self.einsum_num_str,
-            self.r_mat,
-            intensity.reshape(intensity.shape[0], np.prod(intensity.shape[1:])),
-            self.xy_mat,
-            optimize = self.es_path[0]
+        out = np.empty([intensity.shape[0], 2], dtype=np.float32)
+        _cog_kernel(
+            intensity,
+            0.0 if self.thresh is None else self.thresh,
+            self.thresh is not None,
+            out
         )
-        den = np.sum(intensity, axis=(1,2))[:,None]
-        return  (num / den).astype(np.float32)
+        return out
+
+    def cog_valid(self, intensity, valid_idx, scale=1.0, out=None):
+        """compute the centroids of the subapertures `valid_idx` of a batch of
+        [N,npix,npix] images, multiplied by `scale`, and flattened in yao
+        slope format (all x then all y). Invalid subapertures are skipped.
+
+        If `out` ([2*len(valid_idx)], float32) is given, it is written to.
+        """
+        if out is None:
+            out = np.empty(2*len(valid_idx), dtype=np.float32)
+        _cog_kernel_valid(
+            intensity,
+            valid_idx,
+            0.0 if self.thresh is None else self.thresh,
+            self.thresh is not None,
+            scale,
+            out
+        )
+        return out
+
+
+_COG_KERNEL_CUDA = r"""
+// thresholded centre of gravity of the [npix,npix] image `im`, reduced over
+// the 32 threads of a warp. The result is only valid on lane 0.
+__device__ void cog_subap(const float* im, const int npix, const float thresh,
+                          const int clip, const int lane, float* x, float* y)
+{
+    float s = 0.0f, sx = 0.0f, sy = 0.0f;
+    for (int p = lane; p < npix * npix; p += 32) {
+        float val = im[p] - thresh;
+        if (clip && val < 0.0f) val = 0.0f;
+        const float px = (p % npix) - npix / 2.0f + 0.5f;
+        const float py = (p / npix) - npix / 2.0f + 0.5f;
+        s += val;
+        sx += val * px;
+        sy += val * py;
+    }
+    for (int offset = 16; offset > 0; offset /= 2) {
+        s += __shfl_down_sync(0xffffffff, s, offset);
+        sx += __shfl_down_sync(0xffffffff, sx, offset);
+        sy += __shfl_down_sync(0xffffffff, sy, offset);
+    }
+    *x = sx / s;
+    *y = sy / s;
+}
+
+extern "C" __global__
+void cog_kernel(const float* intensity, const int n, const int npix,
+                const float thresh, const int clip, float* out)
+{
+    // one warp per subaperture
+    const int b = (blockIdx.x * blockDim.x + threadIdx.x) / 32;
+    const int lane = threadIdx.x % 32;
+    if (b >= n) return;
+    float x, y;
+    cog_subap(intensity + (size_t)b * npix * npix, npix, thresh, clip, lane,
+              &x, &y);
+    if (lane == 0) {
+        out[2 * b] = x;
+        out[2 * b + 1] = y;
+    }
+}
+
+extern "C" __global__
+void cog_kernel_valid(const float* intensity, const int* idx, const int m,
+                      const int npix, const float thresh, const int clip,
+                      const float scale, float* out)
+{
+    // one warp per valid subaperture, written in yao slope format
+    const int k = (blockIdx.x * blockDim.x + threadIdx.x) / 32;
+    const int lane = threadIdx.x % 32;
+    if (k >= m) return;
+    float x, y;
+    cog_subap(intensity + (size_t)idx[k] * npix * npix, npix, thresh, clip,
+              lane, &x, &y);
+    if (lane == 0) {
+        out[k] = x * scale;
+        out[m + k] = y * scale;
+    }
+}
+"""
+
+
+def _pinned_empty(shape):
+    """Empty float32 array in pinned host memory, so that device to host
+    copies into it can be asynchronous.
+    """
+    size = int(np.prod(shape))
+    mem = cp.cuda.alloc_pinned_memory(4*size)
+    return np.frombuffer(mem, np.float32, size).reshape(shape)
+
+
+class ClassicCogGPU(ClassicCog):
+    """ClassicCog on a CUDA device, for use with `SHWFS_GPU`.
+
+    Each subaperture is reduced by a single warp (2 warps per block), and the
+    slopes are copied back to a pinned host buffer on a separate stream.
+    """
+    kernel: object = None
+    kernel_valid: object = None
+    copy_stream: object = None
+    copy_done: object = None
+    out_gpu: object = None
+    out_host: np.ndarray = None
+    valid_idx: np.ndarray = None
+    valid_idx_gpu: object = None
+    valid_out_gpu: object = None
+    valid_out_host: np.ndarray = None
+
+    def calibrate(self):
+        """Compile the CUDA kernels. Called on the first `cog` if not done
+        before.
+        """
+        if cp is None:
+            raise ImportError("ClassicCogGPU requires cupy")
+        module = cp.RawModule(code=_COG_KERNEL_CUDA)
+        self.kernel = module.get_function("cog_kernel")
+        self.kernel_valid = module.get_function("cog_kernel_valid")
+        self.copy_stream = cp.cuda.Stream(non_blocking=True)
+        self.cog(cp.zeros([1, self.npix, self.npix], dtype=cp.float32))
+
+    def _wait_copy(self):
+        """Make the current stream wait for the last copy back, so that a
+        launch doesn't overwrite a device buffer that is still being copied.
+        """
+        if self.copy_done is not None:
+            cp.cuda.get_current_stream().wait_event(self.copy_done)
+
+    def _copy_back(self, out_gpu, out_host):
+        """Queue the copy of `out_gpu` to `out_host` after the work on the
+        current stream, returning an event recorded after the copy.
+        """
+        self.copy_stream.wait_event(cp.cuda.get_current_stream().record())
+        out_gpu.get(stream=self.copy_stream, out=out_host, blocking=False)
+        self.copy_done = self.copy_stream.record()
+        return self.copy_done
+
+    def cog_async(self, intensity):
+        """Launch the centroider on the current stream for the batch of
+        [N,npix,npix] images in `intensity` (on device), and queue the copy
+        of the slopes back to the host.
+
+        Returns the [N,2] host array and a `cupy.cuda.Event` which must be
+        synchronized on before the host array is read. The host array is
+        reused by the next call (which waits for this copy on the device), so
+        it must be read or copied before then.
+        """
+        if self.kernel is None:
+            self.calibrate()
+        self._wait_copy()
+        if len(intensity.shape)==2:
+            intensity = intensity[None,...]
+        n = intensity.shape[0]
+        if self.out_gpu is None or self.out_gpu.shape[0] != n:
+            self.out_gpu = cp.empty([n, 2], dtype=cp.float32)
+            self.out_host = _pinned_empty([n, 2])
+        intensity = cp.ascontiguousarray(cp.asarray(intensity, dtype=cp.float32))
+        self.kernel(
+            ((n+1)//2,), (64,),
+            (
+                intensity, np.int32(n), np.int32(self.npix),
+                np.float32(0.0 if self.thresh is None else self.thresh),
+                np.int32(self.thresh is not None), self.out_gpu
+            )
+        )
+        return self.out_host, self._copy_back(self.out_gpu, self.out_host)
+
+    def cog_valid_async(self, intensity, valid_idx, scale=1.0):
+        """Launch the centroider on the current stream for the subapertures
+        `valid_idx` of the batch of [N,npix,npix] images in `intensity` (on
+        device), multiplied by `scale` and in yao slope format, and queue the
+        copy of the slopes back to the host.
+
+        Returns the [2*len(valid_idx)] host array and a `cupy.cuda.Event`
+        which must be synchronized on before the host array is read. The host
+        array is reused by the next call (which waits for this copy on the
+        device), so it must be read or copied before then.
+        """
+        if self.kernel is None:
+            self.calibrate()
+        self._wait_copy()
+        if valid_idx is not self.valid_idx:
+            # the indices are usually fixed, so only upload them on a change
+            self.valid_idx = valid_idx
+            self.valid_idx_gpu = cp.asarray(valid_idx, dtype=cp.int32)
+            m = len(valid_idx)
+            self.valid_out_gpu = cp.empty(2*m, dtype=cp.float32)
+            self.valid_out_host = _pinned_empty([2*m])
+        m = len(valid_idx)
+        intensity = cp.ascontiguousarray(cp.asarray(intensity, dtype=cp.float32))
+        self.kernel_valid(
+            ((m+1)//2,), (64,),
+            (
+                intensity, self.valid_idx_gpu, np.int32(m),
+                np.int32(self.npix),
+                np.float32(0.0 if self.thresh is None else self.thresh),
+                np.int32(self.thresh is not None), np.float32(scale),
+                self.valid_out_gpu
+            )
+        )
+        return self.valid_out_host, self._copy_back(
+            self.valid_out_gpu, self.valid_out_host
+        )
+
+    def cog(self, intensity):
+        """compute the centroid of an [npix,npix] image or batch of 
+        [N,npix,npix] images (on device), returned as a numpy array.
+        """
+        out, done = self.cog_async(intensity)
+        done.synchronize()
+        return out.copy()
+
+    def cog_valid(self, intensity, valid_idx, scale=1.0, out=None):
+        """compute the centroids of the subapertures `valid_idx` of a batch of
+        [N,npix,npix] images (on device), as in `ClassicCog.cog_valid`.
+        """
+        slopes, done = self.cog_valid_async(intensity, valid_idx, scale)
+        done.synchronize()
+        if out is None:
+            return slopes.copy()
+        out[:] = slopes
+        return out
 
 
 if __name__ == "__main__":
     pup_width = 64
     fovx = 8 # pixels
     nsubx = 32 # across diameter
+    use_gpu = False # requires cupy and a CUDA device
     pupil = aotools.circle(pup_width//2, pup_width).astype(bool)
 
     shm_suffix = "-scaosim"
@@ -304,12 +978,15 @@ if __name__ == "__main__":
         xx_max = 500 # only propagate the first 500 modes in the state, for speed
     )
 
-    shwfs = SHWFS(pupil=pupil, nsubx=nsubx, fovx=fovx)
+    if use_gpu:
+        shwfs = SHWFS_GPU(pupil=pupil, nsubx=nsubx, fovx=fovx)
+    else:
+        shwfs = SHWFS(pupil=pupil, nsubx=nsubx, fovx=fovx)
     phi = phasescreen.phase
     shwfs.measure(phi)
     im = shwfs.image
 
-    cog = ClassicCog(
+    cog = (ClassicCogGPU if use_gpu else ClassicCog)(
         npix=fovx,
         thresh=0.0,
     )
@@ -320,21 +997,41 @@ if __name__ == "__main__":
     flux = shwfs.image_batched.sum(axis=(1,2))
     
     valid = flux > (0.9*flux.max())
+    valid_idx = np.flatnonzero(valid)
+    slopes = np.empty(2*valid_idx.size, dtype=np.float32)
     
     shm_slopes = SHM("slopes"+shm_suffix,((valid.sum()*2,),np.float32))
     shm_valid = SHM("validsubaps"+shm_suffix,((nsubx,nsubx),np.uint8))
     shm_valid.set_data(valid.astype(np.uint8).reshape([nsubx,nsubx]))
-    shm_wfsim = SHM("wfsimg"+shm_suffix,(shwfs.image.shape,np.float32))
+    # wfs image is quantised to uint8, normalised to its peak, which is
+    # published alongside it
+    wfsim, _ = shwfs.image_uint8()
+    shm_wfsim = SHM("wfsimg"+shm_suffix,(wfsim.shape,np.uint8))
+    shm_wfsim_peak = SHM("wfsimgpeak"+shm_suffix,((1,),np.float32))
+    wfsim_peak = np.zeros(1, dtype=np.float32)
 
     pbar = tqdm()
     while True:
         phasescreen.step()
         phi = phasescreen.phase
         shwfs.measure(phi)
-        slopes = cog.cog(shwfs.image_batched)[valid].T.flatten() # yao slope fmt
-        slopes *= shwfs.pixel_scale
+        if use_gpu:
+            # the slopes are copied back while the rest of the frame is
+            # published, and only waited on before they are written to shm
+            slopes, slopes_done = cog.cog_valid_async(
+                shwfs.image_batched_view, valid_idx, shwfs.pixel_scale
+            ) # yao slope fmt
+        else:
+            cog.cog_valid(
+                shwfs.image_batched_view, valid_idx, shwfs.pixel_scale,
+                out=slopes
+            ) # yao slope fmt
         shm_phase.set_data(phi)
+        _, wfsim_peak[0] = shwfs.image_uint8(out=wfsim)
+        if use_gpu:
+            slopes_done.synchronize()
         shm_slopes.set_data(slopes)
-        shm_wfsim.set_data(shwfs.image.astype(np.float32))
-        pbar.set_description(f"rms wf: {phi[pupil==1].std():0.4f} um")
+        shm_wfsim.set_data(wfsim)
+        shm_wfsim_peak.set_data(wfsim_peak)
+        pbar.set_description(f"rms wf: {phasescreen.x.std():0.4f} um")
         pbar.update()
\ No newline at end of file
@@ -13,6 +13,7 @@ if __name__ == "__main__":
     fovx = 8 # pixels
     nsubx = 32 # across diameter
     pupil = aotools.circle(pup_width//2, pup_width).astype(bool)
+    pupil_idx = np.flatnonzero(pupil.ravel())
 
     shm_suffix = "-scaosim"
     shm_atmos = SHM("turb"+shm_suffix)
@@ -20,17 +21,17 @@ if __name__ == "__main__":
 
     pbar = tqdm()
     fps = 30
-    t = time.time()
+    t = time.monotonic()
     while True:
         phi_atmos = shm_atmos.get_data()
         phi_recon = shm_recon.get_data()
         residual = phi_atmos - phi_recon
-        residual *= pupil
-        while True:
-            if time.time() - t > 1/fps:
-                t = time.time()
-                break
-            else:
-                time.sleep((1/fps)/100)
-        pbar.set_description(f"rms wf: {residual[pupil==1].std():0.4f} um")
+        residual = residual.ravel()[pupil_idx]
+        deadline = t + 1/fps
+        sleep = deadline - time.monotonic()
+        if sleep > 0:
+            time.sleep(sleep)
+        now = time.monotonic()
+        t = now if now > deadline else deadline
+        pbar.set_description(f"rms wf: {residual.std():0.4f} um")
         pbar.update()
\ No newline at end of file
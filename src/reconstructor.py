@@ -26,7 +26,7 @@ if __name__ == "__main__":
 
     pbar = tqdm()
     fps = 100
-    t = time.time()
+    t = time.monotonic()
     while True:
         s = shm_slopes.get_data()
         phi = reconstruct_phi(s)
@@ -34,9 +34,9 @@ if __name__ == "__main__":
         pbar.set_description(f"slopes std: {s.std():0.4f} arcsec")
         pbar.update()
         
-        while True:
-            if time.time() - t > 1/fps:
-                t = time.time()
-                break
-            else:
-                time.sleep((1/fps)/100)
\ No newline at end of file
+        deadline = t + 1/fps
+        sleep = deadline - time.monotonic()
+        if sleep > 0:
+            time.sleep(sleep)
+        now = time.monotonic()
+        t = now if now > deadline else deadline
\ No newline at end of file